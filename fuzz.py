@@ -0,0 +1,359 @@
+#!/usr/bin/env python3
+
+# Differential fuzzing for the whole pipeline: random closed λ-terms are pushed through
+# translate_compile_run() and the printed results are compared with what a dumb reference evaluator,
+# written straight from the definition of call-by-value, thinks they should be. On top of that, the stats
+# of every run are grouped by the term size, so that if a change makes the translator or the generated
+# code grow faster than it should, it shows up in the table as the sizes go up.
+
+import os
+import random
+import signal
+import subprocess
+import sys
+import tempfile
+import threading
+
+from olc_ast import lam, app, lam2str
+from olc_parser import parse
+from natives import canonical, subst, free_vars
+from main import translate_compile_run, Interaction, TIME_STATS, SIZE_STATS
+from utils import delete_file, percentile
+
+# Few names mean lots of shadowing, which is exactly where the bugs like to hide. But the closure slots are
+# allocated per name, so a closure can't capture more variables than there are names, and the terms meant
+# to stress the environment building need lots of them
+SHADOWING_NAMES = ['x', 'y', 'z', 'a', 'b']
+
+# The given number of names, or if it's 0, the number that grows with the size of the term
+def name_pool(size, count):
+    if count == 0:
+        count = max(len(SHADOWING_NAMES), size // 4)
+    if count <= len(SHADOWING_NAMES):
+        return SHADOWING_NAMES[:count]
+    return [f'v{i}' for i in range(count)]
+
+# Generates a random closed term of roughly the given size (number of variables, λs and applications).
+# The sharing is the probability of generating a let (that is, (λv. e2) e1) instead of an ordinary node,
+# and also the probability of a variable in e2 being one of the let-bound variables, so that their values
+# get used more than once.
+#
+# A λ is already a value, so a term that is mostly λs does no β-reductions at all and only tests show().
+# That's why the parts of the term that are going to be evaluated (the "active" ones: the top, both sides
+# of an evaluated application, and the body of a λ that is applied right away) are biased towards redexes
+def random_term(rng, size, max_depth, sharing, names):
+    def gen(size, depth, scope, shared, active):
+        # Nothing to refer to yet, so it's either a λ or an application of two closed terms
+        if not scope:
+            if size < 3 or (not active and rng.random() < 0.5):
+                return gen_lam(size, depth, scope, shared, False)
+            return gen_app(size, depth, scope, shared, active)
+
+        if size <= 1 or depth >= max_depth:
+            if shared and rng.random() < sharing:
+                return rng.choice(shared)
+            return rng.choice(scope)
+
+        roll = rng.random()
+        if roll < sharing and size >= 4:
+            name = rng.choice(names)
+            arg_size = rng.randint(1, size - 3)
+            arg = gen(arg_size, depth + 1, scope, shared, active)
+            body = gen(size - arg_size - 2, depth + 2, scope + (name,), shared + (name,), active)
+            return app(lam(name, body), arg)
+
+        lam_chance = (1 - sharing) / (4 if active else 2)
+        if roll < sharing + lam_chance or size < 3:
+            return gen_lam(size, depth, scope, shared, False)
+
+        return gen_app(size, depth, scope, shared, active)
+
+    # In an active application the function is a λ half of the time, which makes it a redex
+    def gen_app(size, depth, scope, shared, active):
+        fun_size = rng.randint(1, size - 2)
+        if active and (not scope or rng.random() < 0.5):
+            fun = gen_lam(fun_size, depth + 1, scope, shared, True)
+        else:
+            fun = gen(fun_size, depth + 1, scope, shared, active)
+        return app(fun, gen(size - fun_size - 1, depth + 1, scope, shared, active))
+
+    def gen_lam(size, depth, scope, shared, applied):
+        name = rng.choice(names)
+        return lam(name, gen(size - 1, depth + 1, scope + (name,), shared, applied))
+
+    return gen(size, 0, (), (), True)
+
+# The size random_term() was aiming for, counted the same way: the parameters of λs are not counted
+def node_count(term):
+    if isinstance(term, str):
+        return 1
+
+    kind, car, cdr = term
+    if kind == 'LAM':
+        return 1 + node_count(cdr)
+
+    return 1 + node_count(car) + node_count(cdr)
+
+
+# Random terms never contain the std.lam definitions, so they never reach the native byte arithmetic.
+# These queries are evaluated with all the definitions from std.lam let-bound around them, which is what
+# --natives is supposed to recognise, and they are picked to poke at the recognition: partial applications
+# of the natives, native names rebound to something else, definitions that rely on a rebound "true", and
+# overflowing the bytes
+STD_LAM = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'std.lam')
+
+STD_QUERIES = [
+    'byte_add',
+    'byte_add byte_3',
+    'byte_eq byte_3',
+    'byte_iszero',
+    'byte_add byte_127 byte_2',
+    'byte_add byte_255 byte_1',
+    'byte_add byte_255 byte_255',
+    'byte_iszero (byte_add byte_255 byte_1)',
+    'byte_iszero byte_128',
+    'byte_eq (byte_add byte_1 byte_2) byte_3',
+    'byte_eq byte_0 byte_255',
+    'byte_adc byte_255 byte_1',
+    'byte_add (fst (byte_adc byte_255 byte_3)) byte_128',
+    '(λbyte_add. byte_add byte_1 byte_2) byte_eq',
+    '(λbyte_add. byte_add byte_1) (λx. λy. x)',
+    '(λtrue. (λor. or false false) (λb1. λb2. b1 true b2)) false',
+    '(λtrue. byte true true true true true true true true) false',
+    '(λplus. plus byte_3 byte_3) (λx. λy. fst (byte_adc x y))',
+    'fib byte_0',
+    'fib byte_8',
+]
+
+STD_OPERATIONS = [
+    'byte_add n m',
+    'byte_eq n m',
+    'byte_iszero n',
+    'byte_add (byte_add n m) n',
+    'byte_iszero (byte_add n m)',
+    'byte_eq (byte_add n m) (byte_add m n)',
+    'byte_adc n m',
+]
+
+# The interaction with all the ":s" definitions from std.lam, and none of its evaluations
+def std_interaction():
+    interaction = Interaction()
+    interaction.cmd_execute_file(STD_LAM)
+    while interaction.input_buffer:
+        line = interaction.input('')
+        if line.lstrip().startswith(':s'):
+            interaction.parse_cmd(line)
+    return interaction
+
+# The fixed queries, and then random operations on random byte literals, all wrapped into the std.lam lets
+def std_terms(rng, count):
+    def literal():
+        return 'byte ' + ' '.join(rng.choice(['true', 'false']) for _ in range(8))
+
+    queries = list(STD_QUERIES)
+    for _ in range(count):
+        queries.append(f'(λn. (λm. {rng.choice(STD_OPERATIONS)}) ({literal()})) ({literal()})')
+
+    interaction = std_interaction()
+    return [interaction.build_full_term(parse(query, lambda prompt: '')) for query in queries]
+
+
+class OutOfFuel(Exception):
+    pass
+
+# Call-by-value, environment-based, and evaluating the function before the argument, just like the
+# generated code. Values are (λ-term, environment) pairs. The fuel is the number of β-reductions
+# left, in a list so that the recursive calls could share it
+def evaluate(term, env, fuel):
+    if isinstance(term, str):
+        return env[term]
+
+    kind, car, cdr = term
+    if kind == 'LAM':
+        return term, env
+
+    fun = evaluate(car, env, fuel)
+    arg = evaluate(cdr, env, fuel)
+
+    fuel[0] -= 1
+    if fuel[0] < 0:
+        raise OutOfFuel
+
+    (_, param, body), fun_env = fun
+    return evaluate(body, {**fun_env, param: arg}, fuel)
+
+# What show() should print for the value: the λ-term with the values of its free variables substituted in
+def value_to_term(value):
+    term, env = value
+    for var in free_vars(term):
+        term = subst(term, var, value_to_term(env[var]))
+    return term
+
+def alpha_equal(term1, term2):
+    return canonical(term1, {}, float('inf')) == canonical(term2, {}, float('inf'))
+
+
+# The terms the reference evaluator gives up on are still compiled and run, with a timeout, since those are
+# exactly the ones deep enough to overflow the stack of the generated code. A timeout or a normal exit is
+# fine for them, as there is nothing to compare the result with, but a crash is still a failure
+def run_case(i, size, term, workdir, fuel, timeout, lazy, natives):
+    case = {'index': i, 'term': term, 'size': size, 'nodes': node_count(term), 'stats': {}}
+
+    fuel_left = [fuel]
+    expected = None
+    try:
+        expected = value_to_term(evaluate(term, {}, fuel_left))
+    except OutOfFuel:
+        skip_reason = 'out of fuel'
+    except RecursionError:
+        skip_reason = 'too deep for the reference evaluator'
+    else:
+        case['expected'] = lam2str(expected)
+        case['β-reductions'] = fuel - fuel_left[0]
+
+    ctx = os.path.join(workdir, f'fuzz_{i}')
+    try:
+        output = translate_compile_run(term, ctx, True, lazy, natives, case['stats'], timeout)
+    except subprocess.TimeoutExpired:
+        output = None
+    except Exception as e:
+        case['verdict'] = 'error'
+        case['actual'] = str(e)
+        return case
+
+    if output is None:
+        case['verdict'] = f'timeout after {timeout} s' if expected is not None else f'skipped: {skip_reason}, timed out'
+    else:
+        case['actual'] = output.strip()
+        exit_code = case['stats']['exit code']
+        if exit_code == -signal.SIGSEGV:
+            case['verdict'] = 'stack overflow'
+        elif exit_code != 0:
+            case['verdict'] = f'crash: exit code {exit_code}'
+        elif expected is None:
+            case['verdict'] = f'skipped: {skip_reason}'
+        else:
+            try:
+                matches = alpha_equal(parse(case['actual'], lambda prompt: ''), expected)
+            except Exception:
+                matches = False
+            case['verdict'] = 'ok' if matches else 'mismatch'
+
+    if case['verdict'] == 'ok' or case['verdict'].startswith('skipped'):
+        delete_file(f'{ctx}.c')
+    else:
+        case['c_file'] = f'{ctx}.c'
+    return case
+
+
+# The columns of the table, picked from the stats main.py records
+CURVE_TIME_STATS = ['translate', 'compile', 'exec']
+CURVE_SIZE_STATS = ['C bytes', 'lambdas', 'max env width', 'heap usage']
+for name in CURVE_TIME_STATS + CURVE_SIZE_STATS:
+    if name not in TIME_STATS + SIZE_STATS:
+        raise Exception(f'main.py does not record the stat "{name}" anymore')
+
+# Times measured while other terms are being translated and compiled in parallel are mostly the measure of
+# the contention for the GIL and the CPU, so the times for the curves are measured again, one term at a time
+def timing_pass(cases, runs, workdir, lazy, natives):
+    for size in sorted({case['size'] for case in cases}):
+        passed = [case for case in cases if case['size'] == size and case['verdict'] == 'ok']
+        for case in passed[:runs]:
+            case['timing'] = {}
+            ctx = os.path.join(workdir, f'timing_{case["index"]}')
+            translate_compile_run(case['term'], ctx, False, lazy, natives, case['timing'])
+
+def print_curves(cases):
+    print(f'{"target":>8}{"nodes":>8}{"β":>8}{"runs":>6}' + ''.join(f'{name:>16}' for name in CURVE_TIME_STATS)
+        + f'{"timed":>6}' + ''.join(f'{name:>16}' for name in CURVE_SIZE_STATS) + f'{"C bytes/node":>16}')
+
+    for size in sorted({case['size'] for case in cases}):
+        runs = [case for case in cases if case['size'] == size and 'exit code' in case['stats']]
+        if not runs:
+            continue
+        timed_runs = [case['timing'] for case in runs if 'timing' in case]
+
+        columns = [str(percentile([case['nodes'] for case in runs], 50))]
+        evaluated = [case['β-reductions'] for case in runs if 'β-reductions' in case]
+        columns.append(str(percentile(evaluated, 50)) if evaluated else '-')
+        columns.append(str(len(runs)))
+        for name in CURVE_TIME_STATS:
+            if timed_runs:
+                columns.append(f'{percentile([stats[name] for stats in timed_runs], 50) * 1000:.3f} ms')
+            else:
+                columns.append('-')
+        columns.append(str(len(timed_runs)))
+        for name in CURVE_SIZE_STATS:
+            columns.append(str(percentile([case['stats'].get(name, 0) for case in runs], 50)))
+        columns.append(f'{percentile([case["stats"]["C bytes"] / case["nodes"] for case in runs], 50):.1f}')
+
+        print(f'{size:>8}' + ''.join(f'{column:>8}' for column in columns[:2]) + f'{columns[2]:>6}'
+            + ''.join(f'{column:>16}' for column in columns[3:6]) + f'{columns[6]:>6}'
+            + ''.join(f'{column:>16}' for column in columns[7:]))
+
+def main():
+    import argparse
+    from concurrent.futures import ThreadPoolExecutor
+
+    parser = argparse.ArgumentParser(description='Differential fuzzing of the λ-to-C pipeline')
+    parser.add_argument('--count', type=int, default=20, help='number of terms of each size')
+    parser.add_argument('--sizes', default='8,16,32,64', help='comma-separated term sizes, in nodes')
+    parser.add_argument('--max-depth', type=int, default=1000, help='maximum nesting depth of the terms')
+    parser.add_argument('--sharing', type=float, default=0.2, help='probability of lets and of using the let-bound variables')
+    parser.add_argument('--fuel', type=int, default=10000, help='maximum number of β-reductions for the reference evaluator')
+    parser.add_argument('--timeout', type=float, default=5, help='seconds each compiled term may run for')
+    parser.add_argument('--names', type=int, default=0, help='number of distinct variable names, 0 to grow it with the term size')
+    parser.add_argument('--jobs', type=int, default=os.cpu_count(), help='number of terms compiled and run in parallel')
+    parser.add_argument('--timing-runs', type=int, default=3, help='number of terms of each size timed one at a time')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--lazy', action='store_true', help='compile with call-by-need')
+    parser.add_argument('--natives', action='store_true', help='compile with native byte arithmetic')
+    parser.add_argument('--std', action='store_true',
+        help='instead of random terms, use queries on std.lam definitions and --count random byte operations')
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    sizes = [int(size) for size in args.sizes.split(',')]
+    if args.std:
+        terms = [(0, term) for term in std_terms(rng, args.count)]
+    else:
+        terms = [
+            (size, random_term(rng, size, args.max_depth, args.sharing, name_pool(size, args.names)))
+            for size in sizes for _ in range(args.count)
+        ]
+
+    # The reference evaluator is recursive, and it should be able to go at least as deep as the
+    # generated C code can before it overflows its stack
+    sys.setrecursionlimit(200000)
+    threading.stack_size(512 * 1024 * 1024)
+
+    workdir = tempfile.mkdtemp(prefix='olc_fuzz_')
+    with ThreadPoolExecutor(max_workers=args.jobs) as executor:
+        cases = list(executor.map(
+            lambda it: run_case(it[0], *it[1], workdir, args.fuel, args.timeout, args.lazy, args.natives), enumerate(terms)))
+
+    timing_pass(cases, args.timing_runs, workdir, args.lazy, args.natives)
+
+    failures = [case for case in cases if case['verdict'] != 'ok' and not case['verdict'].startswith('skipped')]
+    for case in failures:
+        print(f'#{case["index"]}: {case["verdict"]}')
+        print(f'\tterm:     {lam2str(case["term"])}')
+        print(f'\texpected: {case.get("expected")}')
+        print(f'\tactual:   {case.get("actual")}')
+        if 'c_file' in case:
+            print(f'\tC file:   {case["c_file"]}')
+    if not os.listdir(workdir):
+        os.rmdir(workdir)
+
+    verdicts = {}
+    for case in cases:
+        verdicts[case['verdict']] = verdicts.get(case['verdict'], 0) + 1
+    print(', '.join(f'{verdict}: {count}' for verdict, count in sorted(verdicts.items())))
+    print()
+    print_curves(cases)
+
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -2,10 +2,10 @@
 
 import os
 
-from utils import put_file_contents, get_file_contents, chop, delete_file
+from utils import put_file_contents, get_file_contents, chop, delete_file, timed, percentile
 from olc_ast import lam, app, lam2str
 from olc_parser import is_var, parse
-from translator import translate
+from translator import translate, translate_batch, pack_queries
 
 
 def get_cc_invocation(c_filename):
@@ -24,38 +24,106 @@ def get_cc_invocation(c_filename):
         ])
         use_shell = True
     else:
-        cmd = ['gcc', '-O3', '-o', exe_filename, c_filename]
+        cmd = ['gcc', '-O3', '-pthread', '-o', exe_filename, c_filename]
         use_shell = False
 
     return cmd, use_shell, obj_filename, exe_filename
 
-def compile_and_run(c_filename):
+# The timeout is for running the executable only, in seconds; when it's exceeded, subprocess.TimeoutExpired is raised
+def compile_and_run(c_filename, stats, timeout=None):
     import subprocess
+    import sys
 
     cmd, use_shell, obj_filename, exe_filename = get_cc_invocation(c_filename)
-    p = subprocess.run(cmd, shell=use_shell, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    with timed(stats, 'compile'):
+        p = subprocess.run(cmd, shell=use_shell, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
 
     if p.returncode != 0:
         raise Exception(f'compilation failed: {p.stdout}\n{p.stderr}')
 
     try:
-        p = subprocess.run([os.path.join('.', exe_filename)], stdout=subprocess.PIPE)
+        with timed(stats, 'exec'):
+            p = subprocess.run([os.path.join('.', exe_filename)], stdout=subprocess.PIPE, stderr=subprocess.PIPE, timeout=timeout)
     finally:
         delete_file(obj_filename)
         delete_file(exe_filename)
 
+    stats['exit code'] = p.returncode
+    for line in parse_runtime_stats(p.stderr.decode(), stats):
+        print(line, file=sys.stderr)
+
     return p.stdout.decode()
 
-def translate_compile_run(term, ctx, keep_c_file):
-    translated = translate(term)
+# Picks up the "NAME: NUMBER" lines the generated programs print on stderr. A batch prints "heap usage"
+# once per query, so the numbers for the same name are summed up. Returns the rest of the lines, e.g.
+# the error messages, which are not stats and should be shown to the user as they are
+def parse_runtime_stats(runtime_stderr, stats):
+    other_lines = []
+    for line in runtime_stderr.splitlines():
+        name, _, number = line.partition(': ')
+        try:
+            number = int(number)
+        except ValueError:
+            try:
+                number = float(number)
+            except ValueError:
+                other_lines.append(line)
+                continue
+        stats[name] = stats.get(name, 0) + number
+    return other_lines
+
+def translate_compile_run(term, ctx, keep_c_file, lazy=False, natives=False, stats=None, timeout=None):
+    if stats is None:
+        stats = {}
+    with timed(stats, 'translate'):
+        translated = translate(term, lazy, natives, stats)
+    return write_compile_run(translated, ctx, keep_c_file, stats, timeout)
+
+# Same as translate_compile_run(), but for a term made by pack_queries(): returns the list of results of
+# all the queries, evaluated in parallel by one executable. Nothing is printed until all the queries are
+# done, so if any of them fails, there are no results at all
+def translate_compile_run_batch(term, query_count, ctx, keep_c_file, natives=False, stats=None):
+    if stats is None:
+        stats = {}
+    with timed(stats, 'translate'):
+        translated = translate_batch(term, query_count, natives, stats)
+    results = write_compile_run(translated, ctx, keep_c_file, stats).splitlines()
+    if stats['exit code'] != 0:
+        raise Exception(f'the batch failed with exit code {stats["exit code"]}, so none of the {query_count} results are available')
+    if len(results) != query_count:
+        raise Exception(f'expected {query_count} results from the batch but got {len(results)}')
+    return results
+
+def write_compile_run(translated, ctx, keep_c_file, stats, timeout=None):
     c_filename = f'{ctx}.c'
-    put_file_contents(c_filename, translated)
+    with timed(stats, 'write'):
+        put_file_contents(c_filename, translated)
+    stats['C bytes'] = len(translated.encode())
     try:
-        return compile_and_run(c_filename)
+        return compile_and_run(c_filename, stats, timeout)
     finally:
         if not keep_c_file:
             delete_file(c_filename)
 
+# The stats recorded by the whole pipeline, in the order they happen. Times are in seconds, "eval time" and
+# "show time" are measured by the generated program itself and are both included in the "exec" time
+TIME_STATS = ['parse', 'build_full_term', 'translate', 'write', 'compile', 'exec', 'eval time', 'show time']
+SIZE_STATS = ['C bytes', 'lambdas', 'max env width', 'heap usage', 'shared heap usage', 'thunks forced', 'thunks allocated']
+
+def format_stats(stats):
+    times = [f'{name} {stats[name] * 1000:.3f} ms' for name in TIME_STATS if name in stats]
+    sizes = [f'{name} {stats[name]}' for name in SIZE_STATS if name in stats]
+    return ', '.join(times) + '\n' + ', '.join(sizes)
+
+# Percentiles over a list of stats dicts, e.g. over a whole session. Returns {name => (count, p50, p90, p99, max)}
+def summarize_stats(stats_list):
+    summary = {}
+    for name in TIME_STATS + SIZE_STATS:
+        values = [stats[name] for stats in stats_list if name in stats]
+        if values:
+            summary[name] = (len(values), *(percentile(values, p) for p in [50, 90, 99, 100]))
+    return summary
+
 def do_test(term, ctx):
     print(ctx)
     print(lam2str(term))
@@ -97,6 +165,10 @@ class Interaction:
         self.should_quit = False
         self.defs = []
         self.input_buffer = ''
+        self.lazy = False
+        self.natives = False
+        self.report_stats = False
+        self.stats_history = []
 
     def interact(self):
         import sys
@@ -141,16 +213,29 @@ class Interaction:
                 self.cmd_forget_all_macros(s)
             elif cmd == 'o':
                 self.cmd_execute_file(s)
+            elif cmd == 'b':
+                self.cmd_eval_file_in_batch(s)
+            elif cmd == 'm':
+                self.cmd_set_eval_model(s)
+            elif cmd == 'n':
+                self.cmd_set_natives(s)
+            elif cmd == 't':
+                self.cmd_toggle_stats(s)
+            elif cmd == 'ts':
+                self.cmd_summarize_stats(s)
             elif cmd == 'h':
                 self.cmd_help(s)
             else:
                 raise Exception(f'unknown command: {cmd}. Try ":h" for help')
         else:
-            self.cmd_eval_and_print_term(parse(s, self.input))
+            stats = {}
+            with timed(stats, 'parse'):
+                term = parse(s, self.input)
+            self.cmd_eval_and_print_term(term, stats)
 
-    def cmd_eval_and_print_term(self, term):
+    def cmd_eval_and_print_term(self, term, stats=None):
         print(lam2str(term))
-        print(self.eval_term(term))
+        print(self.eval_term(term, stats))
 
     def cmd_quit(self, s):
         self.should_quit = True
@@ -193,6 +278,64 @@ class Interaction:
         if not data.endswith('\n'):
             self.input_buffer += '\n'
 
+    def cmd_eval_file_in_batch(self, s):
+        filename = s
+        lines = get_file_contents(filename).splitlines()
+        prompter = lambda prompt: lines.pop(0) if lines else ''
+
+        stats = {}
+        terms = []
+        with timed(stats, 'parse'):
+            while lines:
+                line = lines.pop(0).lstrip()
+                if line == '' or line.startswith('#'):
+                    continue
+                if line.startswith(':'):
+                    raise Exception(f'only λ-terms are allowed in batch files but found: {line}')
+                terms.append(parse(line, prompter))
+
+        for term, result in zip(terms, self.eval_terms(terms, stats)):
+            print(lam2str(term))
+            print(result)
+
+    def cmd_set_eval_model(self, s):
+        model = s.strip()
+        if model == 'cbv':
+            self.lazy = False
+        elif model == 'cbn':
+            self.lazy = True
+        elif model == '':
+            print('cbn' if self.lazy else 'cbv')
+        else:
+            raise Exception(f'unknown evaluation model: {model}. Try "cbv" or "cbn"')
+
+    def cmd_set_natives(self, s):
+        switch = s.strip()
+        if switch == 'on':
+            self.natives = True
+        elif switch == 'off':
+            self.natives = False
+        elif switch == '':
+            print('on' if self.natives else 'off')
+        else:
+            raise Exception(f'expected "on" or "off" but found {switch}')
+
+    def cmd_toggle_stats(self, s):
+        self.report_stats = not self.report_stats
+        print(f'timing reports are {"on" if self.report_stats else "off"}')
+
+    def cmd_summarize_stats(self, s):
+        summary = summarize_stats(self.stats_history)
+        if not summary:
+            print('nothing has been evaluated yet')
+            return
+
+        print(f'{"":16}{"count":>8}{"p50":>14}{"p90":>14}{"p99":>14}{"max":>14}')
+        for name, (count, *values) in summary.items():
+            if name in TIME_STATS:
+                values = [f'{value * 1000:.3f} ms' for value in values]
+            print(f'{name:16}{count:>8}' + ''.join(f'{value:>14}' for value in values))
+
     def cmd_help(self, s):
         print('Enter a λ-calculus term to evaluate, or a special command. Special commands are:')
         print('\t• :h — prints this help message')
@@ -203,6 +346,11 @@ class Interaction:
         print('\t• :ff — removes all λ-terms from the evaluation environment')
         print('\t• :l — prints the evaluation environment')
         print('\t• :o FILENAME — reads and evaluates all lines from the file named FILENAME')
+        print('\t• :b FILENAME — evaluates all λ-terms from the file named FILENAME in parallel, in a single executable. Only supported for call-by-value. If one of them fails (e.g. applies a native byte operation to a non-byte), the whole batch fails and no results are printed')
+        print('\t• :m [cbv | cbn] — sets the evaluation model to call-by-value or call-by-need, or prints the current one')
+        print('\t• :n [on | off] — turns native byte arithmetic on or off, or prints whether it is on. Only supported for call-by-value')
+        print('\t• :t — turns on or off printing the time each step of the evaluation took and the size of the generated program')
+        print('\t• :ts — prints percentiles of the times and sizes over all the evaluations so far')
         print()
         print('The supported syntax of the λ-calculus term is this EBNF grammar:')
         print('\tTERM  ::=  LAM | APP')
@@ -215,7 +363,8 @@ class Interaction:
             ' pressing [ENTER ⏎] while there are unbalanced open parentheses makes the program expect the continuation of the input'
             ' on the next line(s). Continuation lines are marked by "." prompt instead of the normal ">" prompt.')
         print()
-        print('Evaluation model is call-by-value. Before the input term is evaluated, it is merged with the evaluation environment and the'
+        print('Evaluation model is call-by-value by default, and call-by-need (lazy, with every argument evaluated at most once) after ":m cbn".'
+            ' Before the input term is evaluated, it is merged with the evaluation environment and the'
             ' resulting term is evaluated instead. This merge is done using the usual let=>λ conversion, i.e., let x = e1 in e2  =>  (λx. e2) e1.'
             ' For example, the following sequence of commands:')
         print('\t:s const = λk. λ_. k')
@@ -226,9 +375,32 @@ class Interaction:
         print('\t(λconst. (λzero. (λone. one const zero) (λs. λz. s z)) (λs. λz. z)) (λk. λ_. k)')
         print('which should result in λ_. λs. λz. z')
 
-    def eval_term(self, term):
-        full_term = self.build_full_term(term)
-        return translate_compile_run(full_term, 'tmp', True)
+    # Both eval_term() and eval_terms() record the stats of the evaluation into the stats dict, if given,
+    # and append it to the stats_history, which is what ":ts" summarizes
+    def eval_term(self, term, stats=None):
+        if stats is None:
+            stats = {}
+        with timed(stats, 'build_full_term'):
+            full_term = self.build_full_term(term)
+        result = translate_compile_run(full_term, 'tmp', True, self.lazy, self.natives, stats)
+        self.record_stats(stats)
+        return result
+
+    def eval_terms(self, terms, stats=None):
+        if self.lazy:
+            raise Exception('batch evaluation is only supported for call-by-value')
+        if stats is None:
+            stats = {}
+        with timed(stats, 'build_full_term'):
+            full_term = self.build_full_term(pack_queries(terms))
+        results = translate_compile_run_batch(full_term, len(terms), 'tmp', True, self.natives, stats)
+        self.record_stats(stats)
+        return results
+
+    def record_stats(self, stats):
+        self.stats_history.append(stats)
+        if self.report_stats:
+            print(format_stats(stats))
 
     def build_full_term(self, term):
         result = term
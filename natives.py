@@ -0,0 +1,177 @@
+from olc_ast import lam, app
+from olc_parser import parse
+
+# The definitions from std.lam that the native runtime knows about. A let-bound term is recognised as one
+# of them if it's α-equivalent to the reference, *and* every free variable in it is itself let-bound to
+# a recognised definition of the same name. Names don't matter at all: ":s plus = λx. λy. fst (adc x y)"
+# is still byte_add as long as "fst" and "adc" are recognised as fst and byte_adc
+REFERENCES = {
+    'true': 'λt.λf. t',
+    'false': 'λt.λf. f',
+
+    'not': 'λb. b false true',
+    'and': 'λb1. λb2. b1 b2 false',
+    'or': 'λb1. λb2. b1 true b2',
+    'xor': 'λb1. λb2. b1 (not b2) b2',
+
+    'pair': 'λfst.λsnd. λp. p fst snd',
+    'fst': 'λp. p true',
+
+    'byte': 'λb7.λb6.λb5.λb4.λb3.λb2.λb1.λb0. λf. f b7 b6 b5 b4 b3 b2 b1 b0',
+
+    'byte_iszero': '''λbyte. byte (λb7.λb6.λb5.λb4.λb3.λb2.λb1.λb0.
+        not (or (or (or b7 b6) (or b5 b4)) (or (or b3 b2) (or b1 b0))))''',
+
+    'byte_eq': '''(λbyte1. λbyte2. byte2 (byte1 (
+        λa7.λa6.λa5.λa4.λa3.λa2.λa1.λa0.
+        λb7.λb6.λb5.λb4.λb3.λb2.λb1.λb0.
+            not (or (or (or (xor a7 b7) (xor a6 b6)) (or (xor a5 b5) (xor a4 b4)))
+                    (or (or (xor a3 b3) (xor a2 b2)) (or (xor a1 b1) (xor a0 b0)))))))''',
+
+    'half_adder_cps': 'λa.λb. λk. k (xor a b) (and a b)',
+
+    'full_adder_cps': '''λa.λb.λcin. λk. (
+        half_adder_cps a b (λhalf_s.λhalf_cout.
+        half_adder_cps half_s cin (λs.λhalf_out'.
+        k s (or half_cout half_out')
+    )))''',
+
+    'byte_adc': '''λbyte1. λbyte2. byte2 (byte1 (
+        λa7.λa6.λa5.λa4.λa3.λa2.λa1.λa0.
+            λb7.λb6.λb5.λb4.λb3.λb2.λb1.λb0.
+                half_adder_cps a0 b0 (λs0.λc0.
+                full_adder_cps a1 b1 c0 (λs1.λc1.
+                full_adder_cps a2 b2 c1 (λs2.λc2.
+                full_adder_cps a3 b3 c2 (λs3.λc3.
+                full_adder_cps a4 b4 c3 (λs4.λc4.
+                full_adder_cps a5 b5 c4 (λs5.λc5.
+                full_adder_cps a6 b6 c5 (λs6.λc6.
+                full_adder_cps a7 b7 c6 (λs7.λc7.
+                pair (byte s7 s6 s5 s4 s3 s2 s1 s0) c7
+    ))))))))))''',
+
+    'byte_add': 'λbyte1. λbyte2. fst (byte_adc byte1 byte2)',
+}
+
+# Recognised definitions that have a native implementation, as opposed to the ones that are only
+# recognised so that the definitions using them can be recognised in turn. The value is the number of
+# parameters the native C function takes
+NATIVE_ARITIES = {
+    'byte_iszero': 1,
+    'byte_eq': 2,
+    'byte_add': 2,
+}
+
+# Stands for a captured parameter when printing a partially applied native function. Can't clash with
+# any real variable because the parser would never produce it
+CAPTURED = '%'
+
+BYTE_WIDTH = 8
+
+
+# de Bruijn indices for the bound variables, recognised names for the free ones, and None for the free
+# variables that are not recognised (which makes sure the term will never match any of the references).
+# Gives up and returns None as soon as the term turns out to be bigger than the budget
+def canonical(term, tags, budget):
+    bound = []
+    size = 0
+
+    def walk(term):
+        nonlocal size
+        size += 1
+        if size > budget:
+            raise OverflowError
+
+        if isinstance(term, str):
+            for i in range(len(bound) - 1, -1, -1):
+                if bound[i] == term:
+                    return len(bound) - 1 - i
+            return ('FREE', tags.get(term))
+
+        kind, car, cdr = term
+        if kind == 'LAM':
+            bound.append(car)
+            result = ('LAM', walk(cdr))
+            bound.pop()
+            return result
+
+        return ('APP', walk(car), walk(cdr))
+
+    try:
+        return walk(term)
+    except OverflowError:
+        return None
+
+def subst(term, name, value):
+    if isinstance(term, str):
+        return value if term == name else term
+
+    kind, car, cdr = term
+    if kind == 'LAM':
+        if car == name:
+            return term
+        return lam(car, subst(cdr, name, value))
+
+    return app(subst(car, name, value), subst(cdr, name, value))
+
+def term_size(term):
+    if isinstance(term, str):
+        return 1
+
+    _, car, cdr = term
+    return 1 + term_size(car) + term_size(cdr)
+
+def free_vars(term, bound=frozenset()):
+    if isinstance(term, str):
+        return set() if term in bound else {term}
+
+    kind, car, cdr = term
+    if kind == 'LAM':
+        return free_vars(cdr, bound | {car})
+
+    return free_vars(car, bound) | free_vars(cdr, bound)
+
+
+REFERENCE_TERMS = {name: parse(source, None) for name, source in REFERENCES.items()}
+REFERENCE_TAGS = {name: name for name in REFERENCES}
+REFERENCE_BUDGET = max(term_size(term) for term in REFERENCE_TERMS.values())
+CANONICAL_REFERENCES = {
+    canonical(term, REFERENCE_TAGS, REFERENCE_BUDGET): name for name, term in REFERENCE_TERMS.items()
+}
+
+def recognize(term, tags):
+    return CANONICAL_REFERENCES.get(canonical(term, tags, REFERENCE_BUDGET))
+
+# "byte" applied to exactly BYTE_WIDTH variables each of which is either "true" or "false", most
+# significant bit first. Returns the number, or None if the term is anything else
+def recognize_byte_literal(term, tags):
+    bits = []
+    while not isinstance(term, str) and term[0] == 'APP' and len(bits) <= BYTE_WIDTH:
+        _, term, bit = term
+        if not isinstance(bit, str) or tags.get(bit) not in ('true', 'false'):
+            return None
+        bits.append(tags[bit] == 'true')
+
+    if not isinstance(term, str) or tags.get(term) != 'byte' or len(bits) != BYTE_WIDTH:
+        return None
+
+    return sum(bit << i for i, bit in enumerate(bits))
+
+# The reference with all the other references it uses substituted in, i.e. what a call-by-value run
+# would print for it
+def expand(name):
+    term = REFERENCE_TERMS[name]
+    for free in free_vars(term):
+        term = subst(term, free, expand(free))
+    return term
+
+# The terms for every stage of a curried native function, with the parameters applied so far replaced by
+# CAPTURED placeholders, so that show() could print them exactly like the λ-defined version would be printed
+def native_stages(name):
+    term = expand(name)
+    stages = []
+    for i in range(NATIVE_ARITIES[name]):
+        stages.append(term)
+        _, param, body = term
+        term = subst(body, param, f'{CAPTURED}{i}')
+    return stages
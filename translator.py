@@ -1,9 +1,27 @@
 from olc_ast import lam, app, lam2str
+from natives import NATIVE_ARITIES, BYTE_WIDTH, CAPTURED, recognize, recognize_byte_literal, native_stages
+
+# Wall-clock seconds, for the "eval time" and "show time" the generated programs report on stderr
+TIMER = r'''
+static double now(void) {
+    struct timespec ts;
+    timespec_get(&ts, TIME_UTC);
+    return ts.tv_sec + ts.tv_nsec / 1e9;
+}
+'''
 
 
 # Gonna need some context
 class Translator:
-    def __init__(self):
+    # What the variables (and thus the environment slots) hold at run time: for call-by-value,
+    # it's just the already evaluated values
+    slot_type = 'Value'
+
+    # With query_count set, the term must evaluate to a λK. K q0 ... qN (see pack_queries()), and
+    # the generated program evaluates every query (on a pool of threads) instead of the term itself
+    def __init__(self, query_count=None):
+        self.query_count = query_count
+
         self.counter = 0
         self.buffer = []
         self.indentation = ''
@@ -16,23 +34,12 @@ class Translator:
 
         self.show_data = []
 
-    def translate(self, term):
-        self.append(r'''#include <stdio.h>
-#include <stdlib.h>
-#include <stddef.h>
-
-typedef struct Value Value;
-
-typedef Value (*Lambda)(Value* env, Value arg);
+        # Not needed for the translation itself, only reported by translate()/translate_batch()
+        self.lambda_count = 0
+        self.max_env_width = 0
 
-struct Value {
-    Lambda fun;
-    Value* env;
-};
-
-static Value* tmpenv;
-static size_t heap_usage;
-''')
+    def translate(self, term):
+        self.generate_preamble()
 
         self.append(f'// {lam2str(term)}')
         self.append('')
@@ -47,7 +54,41 @@ static size_t heap_usage;
             raise Exception(f'unbound variables: {list(map(str, top_level_captures.values()))}')
 
         self.generate_show()
+        self.generate_main()
+
+        return '\n'.join(self.buffer)
 
+    def generate_preamble(self):
+        self.append(r'''#include <stdio.h>
+#include <stdlib.h>
+#include <stddef.h>
+#include <time.h>''')
+
+        if self.query_count is not None:
+            self.append(r'''#include <stdatomic.h>
+#include <pthread.h>
+#include <unistd.h>''')
+
+        self.append(r'''
+typedef struct Value Value;
+
+typedef Value (*Lambda)(Value* env, Value arg);
+
+struct Value {
+    Lambda fun;
+    Value* env;
+};
+''')
+
+        # Every query is evaluated entirely by one thread, so per-thread temporaries and counters are
+        # enough to keep the threads from stepping on each other. As for the heap, malloc() already keeps
+        # separate arenas for separate threads, and nothing is ever freed anyway
+        storage = 'static' if self.query_count is None else 'static _Thread_local'
+        self.append(f'{storage} Value* tmpenv;')
+        self.append(f'{storage} size_t heap_usage;')
+        self.append(TIMER)
+
+    def generate_main(self):
         # I don't quite know how to handle the top-level expression better. But it's possible, of course
         self.append(r'''
 Value dummy_lambda(Value* env, Value arg) {
@@ -55,23 +96,111 @@ Value dummy_lambda(Value* env, Value arg) {
     exit(1);
 }''')
 
+        if self.query_count is not None:
+            self.generate_batch_main()
+            return
+
         self.append(r'''
 int main(int argc, char **argv) {
     Value dummy = { .fun = dummy_lambda, .env = NULL };
-    show(body(NULL, dummy), 0);
+    double started = now();
+    Value result = body(NULL, dummy);
+    double evaluated = now();
+    show(result, 0);
     printf("\n");
+    double shown = now();
     fprintf(stderr, "heap usage: %zu\n", heap_usage);
+    fprintf(stderr, "eval time: %.9f\n", evaluated - started);
+    fprintf(stderr, "show time: %.9f\n", shown - evaluated);
 }
 ''')
 
-        return '\n'.join(self.buffer)
+    # The packed term is applied to collect_query() which just stashes the queries away, then the worker
+    # threads grab the queries one by one. The results are printed only after all of them are done, so
+    # they come out in the same order the queries came in, no matter which thread finished first
+    def generate_batch_main(self):
+        self.append(f'#define QUERY_COUNT {self.query_count}')
+        self.append(r'''
+static Value queries[QUERY_COUNT];
+static size_t queries_collected;
+static Value results[QUERY_COUNT];
+static size_t heap_usages[QUERY_COUNT];
+static atomic_size_t next_query;
+
+Value collect_query(Value* env, Value arg) {
+    if (queries_collected == QUERY_COUNT) {
+        fprintf(stderr, "%s\n", "too many queries");
+        exit(1);
+    }
+    queries[queries_collected++] = arg;
+    Value collect = { .fun = collect_query, .env = NULL };
+    return collect;
+}
+
+void* worker(void* unused) {
+    Value dummy = { .fun = dummy_lambda, .env = NULL };
+    for (;;) {
+        size_t i = atomic_fetch_add(&next_query, 1);
+        if (i >= QUERY_COUNT) {
+            return NULL;
+        }
+        heap_usage = 0;
+        results[i] = queries[i].fun(queries[i].env, dummy);
+        heap_usages[i] = heap_usage;
+    }
+}
+
+int main(int argc, char **argv) {
+    Value dummy = { .fun = dummy_lambda, .env = NULL };
+    Value collect = { .fun = collect_query, .env = NULL };
+    double started = now();
+    Value packed = body(NULL, dummy);
+    packed.fun(packed.env, collect);
+    if (queries_collected != QUERY_COUNT) {
+        fprintf(stderr, "%s\n", "too few queries");
+        exit(1);
+    }
+    fprintf(stderr, "shared heap usage: %zu\n", heap_usage);
+
+    // OLC_THREADS overrides the number of worker threads, e.g. to compare 1 thread with all the cores
+    const char* threads_override = getenv("OLC_THREADS");
+    long thread_count = threads_override ? atol(threads_override) : sysconf(_SC_NPROCESSORS_ONLN);
+    if (thread_count < 1) {
+        thread_count = 1;
+    }
+    if (thread_count > QUERY_COUNT) {
+        thread_count = QUERY_COUNT;
+    }
+
+    pthread_t threads[QUERY_COUNT];
+    for (long i = 0; i < thread_count; i++) {
+        if (pthread_create(&threads[i], NULL, worker, NULL)) {
+            fprintf(stderr, "%s\n", "failed to start a worker thread");
+            exit(1);
+        }
+    }
+    for (long i = 0; i < thread_count; i++) {
+        pthread_join(threads[i], NULL);
+    }
+    double evaluated = now();
+
+    for (size_t i = 0; i < QUERY_COUNT; i++) {
+        show(results[i], 0);
+        printf("\n");
+        fprintf(stderr, "heap usage: %zu\n", heap_usages[i]);
+    }
+    double shown = now();
+    fprintf(stderr, "eval time: %.9f\n", evaluated - started);
+    fprintf(stderr, "show time: %.9f\n", shown - evaluated);
+}
+''')
 
     def generate_show(self):
         self.append('void show(Value v, int level) {')
         self.indent()
 
         for term, routine_name, body_captures in self.show_data:
-            inv_captures = {v: f'v.env[{k}]' for k, v in body_captures.items()}
+            inv_captures = {v: self.show_captured(k) for k, v in body_captures.items()}
 
             # Nope, you can't switch on function pointers: they are not constants becase linkers is a thing
             self.append(f'if (v.fun == {routine_name}) {{')
@@ -97,6 +226,9 @@ int main(int argc, char **argv) {
         self.append('}')
         self.dedent()
 
+    def show_captured(self, offset):
+        return f'v.env[{offset}]'
+
     # Uses the same idea that lam2str does, but with some meta-twists: it's not immediately obvious when you
     # should generate a recursive call to the C show() function, or call recursively generate_show_meat() itself;
     # the same goes to printing the parentheses: "level" is checked both in Python and in C code. Mind-bending!
@@ -126,7 +258,10 @@ int main(int argc, char **argv) {
                 self.append('printf("(");')
 
             self.append(f'printf("λ%s. ", "{car}");')
-            self.generate_show_meat(cdr, inv_captures, 0)
+
+            # Inside the body, the parameter shadows the captured variable with the same name, if any
+            body_captures = {var: value for var, value in inv_captures.items() if var != car}
+            self.generate_show_meat(cdr, body_captures, 0)
 
             if level > 0:
                 self.append('printf(")");')
@@ -173,6 +308,7 @@ int main(int argc, char **argv) {
 
         routine_name = self.next_routine()
         translated_param = f'arg_{mangle_for_c(param)}'
+        self.lambda_count += 1
 
         self.enter_lambda_body(param, translated_param)
 
@@ -187,7 +323,7 @@ int main(int argc, char **argv) {
     def translate_lambda_body(self, body, routine_name, translated_param):
         body_value, body_stmts = self.translate_term(body)
 
-        self.append(f'Value {routine_name}(Value* env, Value {translated_param}) {{')
+        self.append(f'Value {routine_name}({self.slot_type}* env, {self.slot_type} {translated_param}) {{')
         self.indent()
         self.extend(body_stmts)
         self.append(f'return {body_value};')
@@ -196,27 +332,30 @@ int main(int argc, char **argv) {
 
         return self.leave_lambda_body()
 
-    # Takes the {offset in the environment => name of the captured variable} map and build the
-    # environment according to it. Crucially, the variable lookup is performed outside of the
-    # lambda's body
     def build_lambda_value(self, routine_name, body_captures):
         value = self.next_temp()
 
+        return value, [
+            f'Value {value} = {{ .fun = {routine_name}, .env = {self.build_env(body_captures)} }};'
+        ]
+
+    # Takes the {offset in the environment => name of the captured variable} map and build the
+    # environment according to it. Crucially, the variable lookup is performed outside of the
+    # lambda's body
+    def build_env(self, body_captures):
         translated_captures = [self.lookup_var(body_captures[i]) for i in range(0, len(body_captures))]
 
-        if translated_captures:
-            mem_size = f'{len(translated_captures)} * sizeof(Value)'
-            env = ', '.join([
-                f'(tmpenv = malloc({mem_size})',
-                f'heap_usage += {mem_size}',
-                *[f'tmpenv[{i}] = {c}' for i, c in enumerate(translated_captures)],
-                'tmpenv)'])
-        else:
-            env = 'NULL'
+        self.max_env_width = max(self.max_env_width, len(translated_captures))
 
-        return value, [
-            f'Value {value} = {{ .fun = {routine_name}, .env = {env} }};'
-        ]
+        if not translated_captures:
+            return 'NULL'
+
+        mem_size = f'{len(translated_captures)} * sizeof({self.slot_type})'
+        return ', '.join([
+            f'(tmpenv = malloc({mem_size})',
+            f'heap_usage += {mem_size}',
+            *[f'tmpenv[{i}] = {c}' for i, c in enumerate(translated_captures)],
+            'tmpenv)'])
 
     def translate_app(self, term):
         _, fun, arg = term
@@ -272,6 +411,344 @@ int main(int argc, char **argv) {
         self.captures = self.captures_stack.pop()
         return body_captures
 
+# Call-by-need flavour of the same translator. Variables now hold pointers to thunks instead of values:
+# an argument that is an application gets suspended into a thunk (which is just another lambda-lifted
+# C function, only without a parameter), and a variable is forced only when its value is actually
+# needed. A forced thunk overwrites itself with the result, so a shared argument is computed at most
+# once, and a discarded one is never computed at all
+class LazyTranslator(Translator):
+    slot_type = 'Thunk*'
+
+    def generate_preamble(self):
+        self.append(r'''#include <stdio.h>
+#include <stdlib.h>
+#include <stddef.h>
+#include <time.h>
+
+typedef struct Value Value;
+typedef struct Thunk Thunk;
+
+typedef Value (*Lambda)(Thunk** env, Thunk* arg);
+typedef Value (*Code)(Thunk** env);
+
+struct Value {
+    Lambda fun;
+    Thunk** env;
+};
+
+struct Thunk {
+    Code code;
+    Thunk** env;
+    Value value;
+};
+
+static Thunk** tmpenv;
+static size_t heap_usage;
+static size_t thunks_allocated;
+static size_t thunks_forced;
+''' + TIMER + r'''
+static Thunk* delay(Code code, Thunk** env) {
+    Thunk* t = malloc(sizeof(Thunk));
+    heap_usage += sizeof(Thunk);
+    thunks_allocated++;
+    t->code = code;
+    t->env = env;
+    return t;
+}
+
+static Thunk* ready(Value value) {
+    Thunk* t = delay(NULL, NULL);
+    t->value = value;
+    return t;
+}
+
+static Value force(Thunk* t) {
+    if (t->code) {
+        t->value = t->code(t->env);
+        t->code = NULL;
+        t->env = NULL;
+        thunks_forced++;
+    }
+    return t->value;
+}
+''')
+
+    def generate_main(self):
+        self.append(r'''
+int main(int argc, char **argv) {
+    double started = now();
+    Value result = body(NULL, NULL);
+    double evaluated = now();
+    show(result, 0);
+    printf("\n");
+    double shown = now();
+    fprintf(stderr, "heap usage: %zu\n", heap_usage);
+    fprintf(stderr, "thunks forced: %zu\n", thunks_forced);
+    fprintf(stderr, "thunks allocated: %zu\n", thunks_allocated);
+    fprintf(stderr, "eval time: %.9f\n", evaluated - started);
+    fprintf(stderr, "show time: %.9f\n", shown - evaluated);
+}
+''')
+
+    # Printing a value may need the values of its captured variables, which may have never been forced
+    # so far. Forcing them now can't diverge unless call-by-value evaluation would have diverged anyway
+    def show_captured(self, offset):
+        return f'force(v.env[{offset}])'
+
+    def translate_var(self, var):
+        value = self.next_temp()
+        return value, [
+            f'Value {value} = force({self.lookup_var(var)});'
+        ]
+
+    def translate_app(self, term):
+        _, fun, arg = term
+
+        fun_value, fun_stmts = self.translate_term(fun)
+        arg_thunk, arg_stmts = self.translate_arg(arg)
+
+        value = self.next_temp()
+
+        return value, fun_stmts + arg_stmts + [
+            f'Value {value} = {fun_value}.fun({fun_value}.env, {arg_thunk});'
+        ]
+
+    # Variables are passed along as they are, sharing the thunk. Lambdas are already values so there
+    # is nothing to delay, and only applications actually get suspended
+    def translate_arg(self, term):
+        if isinstance(term, str):
+            return self.lookup_var(term), []
+
+        kind, _, _ = term
+        thunk = self.next_temp()
+
+        if kind == 'LAM':
+            lam_value, lam_stmts = self.translate_lam(term)
+            return thunk, lam_stmts + [
+                f'Thunk* {thunk} = ready({lam_value});'
+            ]
+
+        routine_name = self.next_thunk()
+
+        self.enter_lambda_body('', '')
+        body_value, body_stmts = self.translate_term(term)
+
+        self.append(f'Value {routine_name}(Thunk** env) {{')
+        self.indent()
+        self.extend(body_stmts)
+        self.append(f'return {body_value};')
+        self.dedent()
+        self.append('}')
+
+        body_captures = self.leave_lambda_body()
+
+        return thunk, [
+            f'Thunk* {thunk} = delay({routine_name}, {self.build_env(body_captures)});'
+        ]
+
+    def next_thunk(self):
+        counter = self.counter
+        self.counter += 1
+        return f'thunk_{counter}'
+
+# Call-by-value translator that knows about the bools and bytes from std.lam. Whenever a let (that is,
+# an application of a lambda to something) binds a term recognised as one of the byte operations with
+# a native implementation, or a byte literal, the bound variable gets the native C version instead. Native
+# bytes are still perfectly good λ-terms: applying one to a selector passes it eight native bools, and
+# the native operations accept any byte-shaped closure, not just the native ones
+class NativeTranslator(Translator):
+    def __init__(self, query_count=None):
+        super().__init__(query_count)
+
+        # {variable name => name of the recognised definition it is let-bound to}. Parameters of ordinary
+        # lambdas are bound to None: they shadow whatever definition was visible by the same name
+        self.tags = {}
+        self.natives_used = set()
+
+        true, false = lam('t', lam('f', 't')), lam('t', lam('f', 'f'))
+        bits = [f'b{i}' for i in reversed(range(BYTE_WIDTH))]
+        byte_selection = 'f'
+        for bit in bits:
+            byte_selection = app(byte_selection, bit)
+
+        self.show_data.extend([
+            (true, 'native_true', {}),
+            (true[2], 'native_true_1', {0: 't'}),
+            (false, 'native_false', {}),
+            (false[2], 'native_false_1', {}),
+            (lam('f', byte_selection), 'native_byte', dict(enumerate(bits))),
+        ])
+
+    def generate_preamble(self):
+        super().generate_preamble()
+        self.append(r'''#include <stdint.h>
+''')
+        # The width comes from natives.py, so that the C side always agrees with the show() entries and the
+        # byte literals recognised there
+        self.append(f'#define BYTE_WIDTH {BYTE_WIDTH}')
+        self.append(r'''#define BYTE_MASK ((1u << BYTE_WIDTH) - 1)
+
+Value native_true(Value* env, Value arg_t);
+Value native_false(Value* env, Value arg_t);
+Value native_byte(Value* env, Value arg_f);
+
+// Every native byte is a closure of native_byte over its row of this table, so its number can be
+// recovered from its environment pointer''')
+
+        self.append('static Value byte_bits[1 << BYTE_WIDTH][BYTE_WIDTH] = {')
+        for n in range(1 << BYTE_WIDTH):
+            bits = [n >> i & 1 for i in reversed(range(BYTE_WIDTH))]
+            self.append('\t{ ' + ', '.join('{ native_true, NULL }' if bit else '{ native_false, NULL }' for bit in bits) + ' },')
+        self.append('};')
+
+        self.append(r'''
+static Value native_bool(int bit) {
+    Value v = { .fun = bit ? native_true : native_false, .env = NULL };
+    return v;
+}
+
+static Value native_byte_value(unsigned n) {
+    Value v = { .fun = native_byte, .env = byte_bits[n] };
+    return v;
+}
+
+static Value* capture(Value v) {
+    Value* env = malloc(sizeof(Value));
+    heap_usage += sizeof(Value);
+    env[0] = v;
+    return env;
+}
+
+Value native_true_1(Value* env, Value arg_f) {
+    return env[0];
+}
+
+Value native_true(Value* env, Value arg_t) {
+    Value v = { .fun = native_true_1, .env = capture(arg_t) };
+    return v;
+}
+
+Value native_false_1(Value* env, Value arg_f) {
+    return arg_f;
+}
+
+Value native_false(Value* env, Value arg_t) {
+    Value v = { .fun = native_false_1, .env = NULL };
+    return v;
+}
+
+Value native_byte(Value* env, Value arg_f) {
+    Value v = arg_f;
+    for (int i = 0; i < BYTE_WIDTH; i++) {
+        v = v.fun(v.env, env[i]);
+    }
+    return v;
+}
+
+static int bit_of(Value b) {
+    Value v = b.fun(b.env, native_bool(1));
+    v = v.fun(v.env, native_bool(0));
+    return v.fun == native_true;
+}
+
+// A selector that reads a λ-defined byte one bit at a time. The bits read so far and their count are
+// kept right in the environment pointer, and after the last bit it returns the native byte
+Value native_collect(Value* env, Value arg_bit) {
+    uintptr_t state = (uintptr_t)env;
+    uintptr_t n = (state & BYTE_MASK) << 1 | bit_of(arg_bit);
+    uintptr_t count = (state >> BYTE_WIDTH) + 1;
+    if (count == BYTE_WIDTH) {
+        return native_byte_value(n);
+    }
+
+    Value v = { .fun = native_collect, .env = (Value*)(count << BYTE_WIDTH | n) };
+    return v;
+}
+
+static unsigned byte_of(Value v) {
+    if (v.fun != native_byte) {
+        Value collect = { .fun = native_collect, .env = NULL };
+        v = v.fun(v.env, collect);
+    }
+    if (v.fun != native_byte) {
+        fprintf(stderr, "%s\n", "native byte operation applied to a non-byte");
+        exit(1);
+    }
+    return (unsigned)((v.env - byte_bits[0]) / BYTE_WIDTH);
+}
+
+Value native_byte_iszero(Value* env, Value arg_byte) {
+    return native_bool(byte_of(arg_byte) == 0);
+}
+
+Value native_byte_eq_1(Value* env, Value arg_byte2) {
+    return native_bool(byte_of(env[0]) == byte_of(arg_byte2));
+}
+
+Value native_byte_eq(Value* env, Value arg_byte1) {
+    Value v = { .fun = native_byte_eq_1, .env = capture(arg_byte1) };
+    return v;
+}
+
+Value native_byte_add_1(Value* env, Value arg_byte2) {
+    return native_byte_value((byte_of(env[0]) + byte_of(arg_byte2)) & BYTE_MASK);
+}
+
+Value native_byte_add(Value* env, Value arg_byte1) {
+    Value v = { .fun = native_byte_add_1, .env = capture(arg_byte1) };
+    return v;
+}
+''')
+
+    def translate_lam(self, term, tag=None):
+        _, param, _ = term
+
+        shadowed = self.tags.get(param)
+        self.tags[param] = tag
+        result = super().translate_lam(term)
+        self.tags[param] = shadowed
+
+        return result
+
+    # A let is recognised before its body gets translated, so that the body already knows about it
+    def translate_app(self, term):
+        _, fun, arg = term
+
+        if isinstance(fun, str) or fun[0] != 'LAM':
+            return super().translate_app(term)
+
+        tag = recognize(arg, self.tags)
+        literal = recognize_byte_literal(arg, self.tags)
+
+        fun_value, fun_stmts = self.translate_lam(fun, tag)
+
+        if tag in NATIVE_ARITIES:
+            arg_value, arg_stmts = self.translate_native(tag)
+        elif literal is not None:
+            arg_value = self.next_temp()
+            arg_stmts = [f'Value {arg_value} = native_byte_value({literal});']
+        else:
+            arg_value, arg_stmts = self.translate_term(arg)
+
+        value = self.next_temp()
+
+        return value, fun_stmts + arg_stmts + [
+            f'Value {value} = {fun_value}.fun({fun_value}.env, {arg_value});'
+        ]
+
+    def translate_native(self, name):
+        if name not in self.natives_used:
+            self.natives_used.add(name)
+
+            for i, stage in enumerate(native_stages(name)):
+                routine_name = f'native_{name}' + (f'_{i}' if i else '')
+                self.show_data.append((stage, routine_name, {j: f'{CAPTURED}{j}' for j in range(i)}))
+
+        value = self.next_temp()
+        return value, [
+            f'Value {value} = {{ .fun = native_{name}, .env = NULL }};'
+        ]
+
 def mangle_for_c(name):
     result = ''
     for ch in name:
@@ -285,7 +762,41 @@ def mangle_for_c(name):
             result += ch
     return result
 
-def translate(term):
+def translate(term, lazy=False, natives=False, stats=None):
     # Does anybody know the "proper" way to define such helper classes? You can't really call
     # translate() second time with some other term, it's really just a one-shot context
-    return Translator().translate(term)
+    if lazy and natives:
+        raise Exception('native primitives are only supported for call-by-value evaluation')
+    if lazy:
+        translator = LazyTranslator()
+    elif natives:
+        translator = NativeTranslator()
+    else:
+        translator = Translator()
+    return run_translator(translator, term, stats)
+
+# Packs independent queries into a single term, so that whatever they are wrapped into (e.g. the lets of
+# the REPL's environment) is translated and evaluated only once. The names are not valid variable names
+# for the parser, so they can't clash with anything inside the queries
+def pack_queries(terms):
+    result = 'K'
+    for term in terms:
+        result = app(result, lam('Q', term))
+    return lam('K', result)
+
+def translate_batch(term, query_count, natives=False, stats=None):
+    if query_count < 1:
+        raise Exception('nothing to evaluate')
+    if natives:
+        translator = NativeTranslator(query_count)
+    else:
+        translator = Translator(query_count)
+    return run_translator(translator, term, stats)
+
+# If the stats dict is given, the size of the generated program gets recorded into it
+def run_translator(translator, term, stats):
+    translated = translator.translate(term)
+    if stats is not None:
+        stats['lambdas'] = translator.lambda_count
+        stats['max env width'] = translator.max_env_width
+    return translated
@@ -23,4 +23,28 @@ def delete_file(filename):
     try:
         os.remove(filename)
     except FileNotFoundError:
-        pass
\ No newline at end of file
+        pass
+
+# Records how many seconds the body of the with-statement took into stats[key]
+class timed:
+    def __init__(self, stats, key):
+        self.stats = stats
+        self.key = key
+
+    def __enter__(self):
+        import time
+
+        self.started = time.perf_counter()
+
+    def __exit__(self, *exc_info):
+        import time
+
+        self.stats[self.key] = time.perf_counter() - self.started
+
+# Nearest-rank percentile, no interpolation: always one of the actually observed values
+def percentile(values, p):
+    import math
+
+    ordered = sorted(values)
+    rank = max(1, math.ceil(p / 100 * len(ordered)))
+    return ordered[rank - 1]